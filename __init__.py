@@ -12,10 +12,14 @@ bl_info = {
 
 if "bpy" in locals():
     import importlib
+    if "codec_akimodel" in locals():
+        importlib.reload(codec_akimodel)
     if "import_akimodel" in locals():
         importlib.reload(import_akimodel)
     if "export_akimodel" in locals():
         importlib.reload(export_akimodel)
+    if "budget_akimodel" in locals():
+        importlib.reload(budget_akimodel)
 
 
 import bpy
@@ -74,6 +78,18 @@ class ImportAKIMODEL(bpy.types.Operator, ImportHelper):
             default=False,
             )
 
+    auto_detect_layout: BoolProperty(
+            name="Auto Detect",
+            description="Detect the texture size and vertex colours from the file contents",
+            default=True,
+            )
+
+    import_variants: BoolProperty(
+            name="Import as Variant",
+            description="Attach the UVs and colours to an imported mesh with the same geometry instead of creating a new one",
+            default=False,
+            )
+
     def execute(self, context):
         from . import import_akimodel
         keywords = self.as_keywords(ignore=("filter_glob",))
@@ -110,17 +126,23 @@ class AKIMODEL_PT_import_include(bpy.types.Panel):
         sfile = context.space_data
         operator = sfile.active_operator
  
+        layout.prop(operator, 'auto_detect_layout')
+
         col = layout.column()
+        col.enabled = not operator.auto_detect_layout
         col.label(text = "Texture Setup", icon = 'TEXTURE_DATA')
 
-        row = layout.row()
+        row = col.row()
         row.prop(operator, "width_texture_size")
         row.prop(operator, "height_texture_size")
 
         col2 = layout.column()
+        col2.enabled = not operator.auto_detect_layout
         col2.label(text = "Model Options", icon = 'MESH_DATA')
         col2.prop(operator, 'has_vertex_colours')
 
+        layout.prop(operator, 'import_variants')
+
 
 class ExportAKIMODEL(bpy.types.Operator, ExportHelper):
     """Write a MODEL file"""
@@ -136,13 +158,55 @@ class ExportAKIMODEL(bpy.types.Operator, ExportHelper):
             min=1, max=100,
             default=8,
             )
-    
+
+    triangulate_method: EnumProperty(
+            name="Triangulate",
+            description="How faces are split into the triangles of the index buffer",
+            items=(('LOOP_TRIANGLES', "Loop Triangles", "Read Blender's cached triangulation, leaves the mesh untouched"),
+                   ('BMESH', "BMesh", "Triangulate a copy with BMesh, the face order of earlier exports"),
+                   ),
+            default='LOOP_TRIANGLES',
+            )
+
+    export_sequence: EnumProperty(
+            name="Sequence",
+            description="Write a numbered .model file per frame or per shape key. "
+                        "Only shape keys and Armature modifiers move the vertices, other modifiers are ignored",
+            items=(('NONE', "None", "Export the current state only"),
+                   ('FRAMES', "Frame Range", "Export every frame of the frame range"),
+                   ('SHAPE_KEYS', "Shape Keys", "Export every shape key"),
+                   ),
+            default='NONE',
+            )
+
+    frame_start: IntProperty(
+            name="Start",
+            min=0,
+            default=1,
+            )
+
+    frame_end: IntProperty(
+            name="End",
+            min=0,
+            default=250,
+            )
+
+    def invoke(self, context, event):
+        self.frame_start = context.scene.frame_start
+        self.frame_end = context.scene.frame_end
+
+        return ExportHelper.invoke(self, context, event)
+
     def execute(self, context):
         from . import export_akimodel
 
         keywords = self.as_keywords(ignore=("check_existing","filter_glob",))
 
-        return export_akimodel.save(context, **keywords)
+        try:
+            return export_akimodel.save(context, **keywords)
+        except export_akimodel.ExportError as ex:
+            self.report({'ERROR'}, str(ex))
+            return {'CANCELLED'}
 
     def draw(self, context):
         pass
@@ -158,7 +222,7 @@ class AKIMODEL_PT_export_include(bpy.types.Panel):
         sfile = context.space_data
         operator = sfile.active_operator
 
-        return operator.bl_idname == "EXPORT_SCENE_OT_akimodel"
+        return operator.bl_idname == "EXPORT_SCENE_OT_model"
 
     def draw(self, context):
         layout = self.layout
@@ -169,8 +233,121 @@ class AKIMODEL_PT_export_include(bpy.types.Panel):
         operator = sfile.active_operator
 
         layout.prop(operator, 'global_scale')
+        layout.prop(operator, 'triangulate_method')
+
+        col = layout.column()
+        col.label(text = "Sequence", icon = 'SEQUENCE')
+        col.prop(operator, 'export_sequence')
+
+        sub = col.column(align=True)
+        sub.enabled = operator.export_sequence == 'FRAMES'
+        sub.prop(operator, 'frame_start')
+        sub.prop(operator, 'frame_end')
+
+        if operator.export_sequence != 'NONE':
+            col.label(text = "Only shape keys and armatures are evaluated", icon = 'INFO')
+
+
+
+class AKIMODEL_PT_budget(bpy.types.Panel):
+    bl_space_type = 'VIEW_3D'
+    bl_region_type = 'UI'
+    bl_category = "AKI Model"
+    bl_label = "Export Budget"
+
+    @classmethod
+    def poll(cls, context):
+        return any(ob.type == 'MESH' for ob in context.selected_objects)
+
+    def draw(self, context):
+        from . import budget_akimodel
+
+        layout = self.layout
+
+        for ob in context.selected_objects:
+            if ob.type != 'MESH':
+                continue
+
+            budget = budget_akimodel.get_budget(ob)
+
+            box = layout.box()
+            box.label(text = ob.name, icon = 'MESH_DATA')
+
+            if budget.missing:
+                box.label(text = "Missing %s" % ", ".join(budget.missing), icon = 'ERROR')
+                continue
+
+            col = box.column(align=True)
+
+            row = col.row()
+            row.alert = budget.vertices > budget.vertex_limit
+            row.label(text = "Vertices: %d / %d" % (budget.vertices, budget.vertex_limit))
+
+            row = col.row()
+            row.alert = budget.faces > budget.face_limit
+            row.label(text = "Faces: %d / %d" % (budget.faces, budget.face_limit))
+
+            if budget.position_overflow:
+                col.label(text = "%d vertices overflow at scale %d" % (budget.position_overflow, max(ob.data['scale'], 1)), icon = 'ERROR')
+            if budget.uv_overflow:
+                col.label(text = "%d UVs overflow at %dx%d" % (budget.uv_overflow, ob.data['width'], ob.data['height']), icon = 'ERROR')
+
+
+class AKIMODEL_OT_set_variant(bpy.types.Operator):
+    """Use this variant's UV map, colours and texture settings, they are exported from now on"""
+    bl_idname = "object.akimodel_set_variant"
+    bl_label = "Set Variant"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    variant: StringProperty(name="Variant")
+
+    @classmethod
+    def poll(cls, context):
+        ob = context.active_object
+        return ob is not None and ob.type == 'MESH' and 'variants' in ob.data
+
+    def execute(self, context):
+        from . import import_akimodel
+
+        me = context.active_object.data
+        if self.variant not in me['variants']:
+            self.report({'ERROR'}, "%s has no variant %r" % (me.name, self.variant))
+            return {'CANCELLED'}
+
+        variant = me['variants'][self.variant]
+        if variant['uv'] not in me.uv_layers:
+            self.report({'ERROR'}, "%s has no %r UV map for variant %s" % (me.name, variant['uv'], self.variant))
+            return {'CANCELLED'}
+        if variant['colour'] and variant['colour'] not in me.vertex_colors:
+            self.report({'ERROR'}, "%s has no %r vertex colour layer for variant %s" % (me.name, variant['colour'], self.variant))
+            return {'CANCELLED'}
+
+        import_akimodel.set_variant(me, self.variant)
+        return {'FINISHED'}
+
+
+class AKIMODEL_PT_variants(bpy.types.Panel):
+    bl_space_type = 'VIEW_3D'
+    bl_region_type = 'UI'
+    bl_category = "AKI Model"
+    bl_label = "Variants"
+
+    @classmethod
+    def poll(cls, context):
+        ob = context.active_object
+        return ob is not None and ob.type == 'MESH' and 'variants' in ob.data
+
+    def draw(self, context):
+        layout = self.layout
+
+        me = context.active_object.data
+        active = me.get('active_variant', '')
+
+        col = layout.column(align=True)
+        for name in me['variants'].keys():
+            op = col.operator(AKIMODEL_OT_set_variant.bl_idname, text=name, depress=name == active)
+            op.variant = name
 
-    
 
 def menu_func_import(self, context):
     self.layout.operator(ImportAKIMODEL.bl_idname, text="AKI Model (.model)")
@@ -184,6 +361,9 @@ classes = (
     AKIMODEL_PT_import_include,
     ExportAKIMODEL,
     AKIMODEL_PT_export_include,
+    AKIMODEL_PT_budget,
+    AKIMODEL_OT_set_variant,
+    AKIMODEL_PT_variants,
 )
 
 def register():
@@ -193,8 +373,14 @@ def register():
     bpy.types.TOPBAR_MT_file_import.append(menu_func_import)
     bpy.types.TOPBAR_MT_file_export.append(menu_func_export)
 
+    from . import budget_akimodel
+    budget_akimodel.register()
+
 
 def unregister():
+    from . import budget_akimodel
+    budget_akimodel.unregister()
+
     bpy.types.TOPBAR_MT_file_import.remove(menu_func_import)
     bpy.types.TOPBAR_MT_file_export.remove(menu_func_export)
 
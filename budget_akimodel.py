@@ -0,0 +1,186 @@
+import bpy
+import bmesh
+import numpy as np
+
+from bpy.app.handlers import persistent
+
+from .export_akimodel import (
+    MAX_VERTICES,
+    MAX_VERTICES_UNSCALED,
+    MAX_FACES,
+    variant_layers,
+    position_overflow,
+    uv_overflow,
+)
+
+
+class Budget:
+ def __init__(self):
+    self.vertices           = 0
+    self.faces              = 0
+    self.vertex_limit       = MAX_VERTICES
+    self.face_limit         = MAX_FACES
+    self.position_overflow  = 0
+    self.uv_overflow        = 0
+    self.missing            = []
+
+
+# mesh name -> Budget, dropped by the depsgraph handler when a mesh changes
+_budget_cache = {}
+
+
+def mesh_arrays(ob):
+    """Positions, loop vertices, loop faces, loop UVs and triangle count of the base mesh of ob.
+
+    The UVs come from the UV map of the active variant, the one the export splits and writes.
+    """
+    me = ob.data
+    uv_name = variant_layers(me)[0]
+
+    if ob.mode == 'EDIT':
+        # the mesh data is stale while editing, read the edit mesh without writing it back
+        bm = bmesh.from_edit_mesh(me)
+        bm.verts.index_update()
+        if uv_name is not None:
+            uv_layer = bm.loops.layers.uv.get(uv_name)
+        else:
+            uv_layer = bm.loops.layers.uv.active
+
+        co = np.array([v.co[:] for v in bm.verts], dtype=np.float32).reshape(-1, 3)
+        loops = [(l.vert.index, f_index, l[uv_layer].uv[:] if uv_layer else (0.0, 0.0))
+                 for f_index, face in enumerate(bm.faces) for l in face.loops]
+        tri_count = sum(len(face.verts) - 2 for face in bm.faces)
+
+        loop_vert = np.array([l[0] for l in loops], dtype=np.int64)
+        loop_face = np.array([l[1] for l in loops], dtype=np.int64)
+        loop_uv = np.array([l[2] for l in loops], dtype=np.float32).reshape(-1, 2)
+        has_uv = uv_layer is not None
+
+    else:
+        co = np.empty(len(me.vertices) * 3, dtype=np.float32)
+        me.vertices.foreach_get('co', co)
+        co = co.reshape(-1, 3)
+
+        loop_vert = np.empty(len(me.loops), dtype=np.int32)
+        me.loops.foreach_get('vertex_index', loop_vert)
+        loop_vert = loop_vert.astype(np.int64)
+
+        loop_total = np.empty(len(me.polygons), dtype=np.int32)
+        me.polygons.foreach_get('loop_total', loop_total)
+        loop_face = np.repeat(np.arange(len(me.polygons), dtype=np.int64), loop_total)
+        tri_count = int(np.sum(loop_total - 2))
+
+        if uv_name is not None:
+            uv_layer = me.uv_layers.get(uv_name)
+        else:
+            uv_layer = me.uv_layers.active
+
+        loop_uv = np.zeros(len(me.loops) * 2, dtype=np.float32)
+        has_uv = uv_layer is not None
+        if has_uv:
+            uv_layer.data.foreach_get('uv', loop_uv)
+        loop_uv = loop_uv.reshape(-1, 2)
+
+    return co, loop_vert, loop_face, loop_uv, tri_count, has_uv
+
+
+def uv_island_of_faces(loop_vert, loop_face, loop_uv, face_count):
+    """Island index per face, faces sharing a vertex with the same UV are linked like UV select linked."""
+    keys = np.column_stack((loop_vert, np.round(loop_uv.astype(np.float64) * 10000).astype(np.int64)))
+    if len(keys):
+        loop_key = np.unique(keys, axis=0, return_inverse=True)[1].ravel().tolist()
+    else:
+        loop_key = []
+
+    parent = list(range(face_count))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    first_face = {}
+    for face, key in zip(loop_face.tolist(), loop_key):
+        other = first_face.setdefault(key, face)
+        if other != face:
+            root_a, root_b = find(face), find(other)
+            if root_a != root_b:
+                parent[root_b] = root_a
+
+    return np.array([find(i) for i in range(face_count)], dtype=np.int64)
+
+
+def mesh_budget(ob):
+    """Split vertex and face counts and quantization overflows of ob, as write_file() would produce them."""
+    budget = Budget()
+
+    me = ob.data
+    budget.missing = [key for key in ('scale', 'width', 'height') if key not in me]
+    if budget.missing:
+        return budget
+
+    scale = me['scale']
+    if scale <= 0:
+        budget.vertex_limit = MAX_VERTICES_UNSCALED
+        scale = 1
+
+    co, loop_vert, loop_face, loop_uv, tri_count, has_uv = mesh_arrays(ob)
+    face_count = int(loop_face[-1]) + 1 if len(loop_face) else 0
+
+    # every vertex is duplicated once per UV island it touches, loose vertices stay
+    island = uv_island_of_faces(loop_vert, loop_face, loop_uv, face_count)
+    split_key = loop_vert * max(face_count, 1) + island[loop_face]
+    split_keys = np.unique(split_key)
+    loose = len(co) - len(np.unique(loop_vert))
+
+    budget.vertices = len(split_keys) + loose
+    budget.faces = tri_count
+
+    budget.position_overflow = int(np.count_nonzero(position_overflow(co, scale)))
+
+    if has_uv:
+        budget.uv_overflow = len(np.unique(split_key[uv_overflow(loop_uv, me['width'], me['height'])]))
+
+    return budget
+
+
+def get_budget(ob):
+    budget = _budget_cache.get(ob.data.name)
+    if budget is None:
+        budget = _budget_cache[ob.data.name] = mesh_budget(ob)
+    return budget
+
+
+@persistent
+def depsgraph_update_post(scene, depsgraph):
+    changed = False
+
+    for update in depsgraph.updates:
+        id_data = update.id.original
+
+        if isinstance(id_data, bpy.types.Mesh):
+            changed |= _budget_cache.pop(id_data.name, None) is not None
+        elif isinstance(id_data, bpy.types.Object) and id_data.type == 'MESH' and update.is_updated_geometry:
+            changed |= _budget_cache.pop(id_data.data.name, None) is not None
+
+    if changed and bpy.context.screen is not None:
+        for area in bpy.context.screen.areas:
+            if area.type == 'VIEW_3D':
+                area.tag_redraw()
+
+
+@persistent
+def load_post(dummy):
+    _budget_cache.clear()
+
+
+def register():
+    bpy.app.handlers.depsgraph_update_post.append(depsgraph_update_post)
+    bpy.app.handlers.load_post.append(load_post)
+
+
+def unregister():
+    bpy.app.handlers.depsgraph_update_post.remove(depsgraph_update_post)
+    bpy.app.handlers.load_post.remove(load_post)
+    _budget_cache.clear()
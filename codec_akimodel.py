@@ -0,0 +1,331 @@
+import hashlib
+import os
+import struct
+
+# This module must not import bpy, it is shared with verify_akimodel.py
+# which runs outside of Blender.
+
+HEADER_SIZE = 8
+VERTEX_SIZE = 8
+FACE_SIZE   = 3
+
+HEADER_FIELDS = (
+    'scale',
+    'vertex_count',
+    'face_count',
+    'vertex_influence',
+    'offset_x',
+    'offset_y',
+    'offset_z',
+    'texture_size',
+)
+
+TEXTURE_SIZES = (4, 8, 16, 32, 64, 128, 256)
+
+# per byte field names of a vertex record, depending on the layout
+VERTEX_FIELDS_COLOURS    = ('position_x', 'position_y', 'position_z', 'uv_u', 'uv_v', 'colour_r', 'colour_g', 'colour_b')
+VERTEX_FIELDS_NO_COLOURS = ('position_x', 'position_y', 'position_z', 'padding', 'padding', 'uv_u', 'padding', 'uv_v')
+
+
+class MDL:
+ def __init__(self):
+    self.type               = 0
+    self.scale              = 0
+    self.vertex_count       = 0
+    self.face_count         = 0
+    self.texture_size       = 0
+    self.vertex_influence   = 0
+    self.has_colours        = False
+    self.width              = 64
+    self.height             = 64
+    self.offsets            = []
+    self.vertices           = []
+    self.faces              = []
+    self.uvs                = []
+    self.colours            = []
+
+class LayoutProbe:
+ def __init__(self):
+    self.has_colours        = False
+    self.width              = 64
+    self.height             = 64
+    self.colour_score       = 0.0
+    self.no_colour_score    = 0.0
+
+class TypeFormat:
+    SByte = '<b'
+    Byte = '<B'
+    Int16 = '<h'
+    BInt16 = '>h'
+    UInt16 = '<H'
+    Int32 = '<i'
+    UInt32 = '<I'
+    Int64 = '<l'
+    UInt64 = '<L'
+    Single = '<f'
+    Double = '<d'
+
+
+def quantize_vertex(n, s):
+    return int(round(n * (1.0 * s), 2)) & 0xFF
+
+def quantize_uv(n, s):
+    return int(round(n * s, 2)) & 0xFF
+
+def quantize_offset(n):
+    return int(round(n, 2) * 10) & 0xFF
+
+def quantize_colour(c):
+    return int(round(c * 255, 4))
+
+
+def read_model(data,
+               width_texture_size = 64,
+               height_texture_size = 64,
+               has_vertex_colours = False,
+               ):
+    """Decode the bytes of a .model file into a MDL, exactly as the importer sees them."""
+    mesh = MDL()
+
+    mesh.scale = data[0]
+
+    # meshes without scale are read differently
+    if mesh.scale > 0:
+        mesh.type = 1
+    else:
+        mesh.scale += 1
+
+    mesh.vertex_count       = data[1] & 0x7F
+    mesh.face_count         = data[2]
+    mesh.vertex_influence   = data[3]
+
+    # Offset translate
+    scaleIToF = 0.1
+    ofsX, ofsY, ofsZ = struct.unpack_from('<3b', data, 4)
+    mesh.offsets.append([round(ofsX * scaleIToF, 4), round(ofsY * scaleIToF, 4), round(ofsZ * scaleIToF, 4)])
+
+    # assumed?
+    mesh.texture_size = data[7]
+
+    # force vertex colors on for meshes without scale
+    if mesh.type == 0:
+        has_vertex_colours = True
+
+    mesh.has_colours    = bool(has_vertex_colours)
+    mesh.width          = int(width_texture_size)
+    mesh.height         = int(height_texture_size)
+
+    # correct the scale for verts
+    scaleIToF = 1.0 / mesh.scale
+
+    offset = HEADER_SIZE
+    for v in range(0, mesh.vertex_count):
+        vtX, vtY, vtZ, b0, b1, b2, b3, b4 = struct.unpack_from('<3b5B', data, offset)
+        offset += VERTEX_SIZE
+
+        mesh.vertices.append([round(vtX * scaleIToF, 4), round(vtY * scaleIToF, 4), round(vtZ * scaleIToF, 4)])
+
+        if mesh.type >= 1:
+            if has_vertex_colours:
+                mesh.uvs.append([float(b0) / mesh.width, float(b1) / mesh.height])
+                mesh.colours.append([b2, b3, b4])
+            else:
+                mesh.uvs.append([float(b2) / mesh.width, float(b4) / mesh.height])
+        else:
+            mesh.uvs.append([float(b0) / mesh.width, (float(b1) / mesh.height) * -1 + 1.0])
+            mesh.colours.append([b2, b3, b4])
+
+    for face in range(0, mesh.face_count):
+        mesh.faces.append(list(struct.unpack_from('<3B', data, offset)))
+        offset += FACE_SIZE
+
+    return mesh
+
+
+def geometry_hash(data):
+    """Hash of the scale, offsets, vertex positions and faces of a .model file.
+
+    Texture and palette variants of a model share it, their UV and colour bytes are left out.
+    The offsets become the object location, so variants must agree on them as well.
+    """
+    vertex_count = data[1] & 0x7F
+    face_count = data[2]
+    face_start = HEADER_SIZE + VERTEX_SIZE * vertex_count
+
+    h = hashlib.sha1()
+    h.update(bytes((data[0], vertex_count, face_count)))
+    h.update(data[4:7])
+    for offset in range(HEADER_SIZE, face_start, VERTEX_SIZE):
+        h.update(data[offset:offset + 3])
+    h.update(data[face_start:face_start + FACE_SIZE * face_count])
+
+    return h.hexdigest()
+
+
+def probe_size(uv_bytes, default = 64):
+    """Pick the texture size whose range fits the UV bytes the tightest."""
+    highest = max(uv_bytes, default=0)
+    if highest == 0:
+        return default
+
+    # a UV of 1.0 is stored as the size itself
+    fitting = [(highest / size, size) for size in TEXTURE_SIZES if highest <= size]
+    return max(fitting)[1]
+
+
+def probe_layout(data):
+    """Score the candidate vertex layouts and texture sizes of a .model file from its bytes.
+
+    Without colours bytes 3, 4 and 6 of each vertex record are zero padding, with colours
+    they hold U, V and green. Meshes without scale always carry colours.
+    """
+    probe = LayoutProbe()
+
+    vertex_end = min(HEADER_SIZE + VERTEX_SIZE * (data[1] & 0x7F), len(data))
+    records = [data[i:i + VERTEX_SIZE] for i in range(HEADER_SIZE, vertex_end - VERTEX_SIZE + 1, VERTEX_SIZE)]
+
+    if data[0] == 0:
+        probe.has_colours = True
+        probe.colour_score = 1.0
+    elif any(r[3] or r[4] or r[6] for r in records):
+        # the exporter always zeroes the padding, a single set byte rules the layout out
+        probe.has_colours = True
+        probe.colour_score = 1.0
+    elif records:
+        # every padding byte is zero, colours would need U, V and green to be zero on every vertex
+        probe.no_colour_score = 1.0
+        coloured = sum(1 for r in records if r[5] or r[7])
+        probe.colour_score = 1.0 - coloured / len(records)
+
+        probe.has_colours = probe.colour_score > probe.no_colour_score
+
+    if probe.has_colours:
+        probe.width  = probe_size([r[3] for r in records])
+        probe.height = probe_size([r[4] for r in records])
+    else:
+        probe.width  = probe_size([r[5] for r in records])
+        probe.height = probe_size([r[7] for r in records])
+
+    return probe
+
+
+_probe_cache = {}
+
+def probe_file(filepath, data = None):
+    """probe_layout() of a file, cached per path until the file changes."""
+    st = os.stat(filepath)
+    key = (os.path.abspath(filepath), st.st_mtime_ns, st.st_size)
+
+    probe = _probe_cache.get(key)
+    if probe is None:
+        if data is None:
+            with open(filepath, 'rb') as f:
+                data = f.read()
+        probe = _probe_cache[key] = probe_layout(data)
+
+    return probe
+
+
+def write_model(mesh):
+    """Encode a MDL gathered from Blender into .model bytes, exactly as the exporter writes them.
+
+    mesh.scale is the raw header byte, offsets are the object location, colours are 0..1 floats.
+    """
+    out = bytearray()
+
+    # Write Header
+    out += mesh.scale.to_bytes(1, byteorder='little')
+
+    # Override scale for this particular mesh type
+    scale = mesh.scale
+    if scale <= 0:
+        scale = 1
+        mesh_type = 0
+    else:
+        mesh_type = 1
+
+    vertex_count = len(mesh.vertices)
+
+    # Different vertex count encoding
+    if mesh_type > 0:
+        out += vertex_count.to_bytes(1, byteorder='big')
+    else:
+        # bit encode
+        out.append((vertex_count - 128) & 0xFF)
+
+    # Basic header info
+    out += len(mesh.faces).to_bytes(1, byteorder='big')
+    out += mesh.vertex_influence.to_bytes(1, byteorder='big')
+
+    # offsets
+    local_offsets = mesh.offsets[0]
+    out.append(quantize_offset(local_offsets[0]))
+    out.append(quantize_offset(local_offsets[1]))
+    out.append(quantize_offset(local_offsets[2]))
+    out += mesh.texture_size.to_bytes(1, byteorder='little')
+
+    # Vert
+    for i, co in enumerate(mesh.vertices):
+        out.append(quantize_vertex(co[0], scale))
+        out.append(quantize_vertex(co[1], scale))
+        out.append(quantize_vertex(co[2], scale))
+
+        uv = mesh.uvs[i]
+        if mesh.has_colours:
+            colour = mesh.colours[i]
+            out.append(quantize_uv(uv[0], mesh.width))
+            out.append(quantize_uv((uv[1] * -1) + 1.0, mesh.height))
+
+            out += quantize_colour(colour[0]).to_bytes(1, byteorder='little')
+            out += quantize_colour(colour[1]).to_bytes(1, byteorder='little')
+            out += quantize_colour(colour[2]).to_bytes(1, byteorder='little')
+        else:
+            out += b'\x00\x00'
+            out.append(quantize_uv(uv[0], mesh.width))
+            out += b'\x00'
+            # flip
+            out.append(quantize_uv((uv[1] * -1) + 1.0, mesh.height))
+
+    for face in mesh.faces:
+        for v_idx in face:
+            out += v_idx.to_bytes(1, byteorder='little')
+
+    return bytes(out)
+
+
+def write_model_positions(data, mesh):
+    """Re-encode only the offsets and vertex positions of mesh into bytes made by write_model.
+
+    Used for sequences where the topology, UVs and colours stay the same for every frame.
+    """
+    out = bytearray(data)
+
+    scale = mesh.scale
+    if scale <= 0:
+        scale = 1
+
+    local_offsets = mesh.offsets[0]
+    out[4] = quantize_offset(local_offsets[0])
+    out[5] = quantize_offset(local_offsets[1])
+    out[6] = quantize_offset(local_offsets[2])
+
+    offset = HEADER_SIZE
+    for co in mesh.vertices:
+        out[offset]     = quantize_vertex(co[0], scale)
+        out[offset + 1] = quantize_vertex(co[1], scale)
+        out[offset + 2] = quantize_vertex(co[2], scale)
+        offset += VERTEX_SIZE
+
+    return bytes(out)
+
+
+def field_layout(mesh):
+    """Field name of every byte of a .model file with the layout of mesh, for reporting."""
+    if mesh.has_colours:
+        vertex_fields = VERTEX_FIELDS_COLOURS
+    else:
+        vertex_fields = VERTEX_FIELDS_NO_COLOURS
+
+    return (list(HEADER_FIELDS)
+            + list(vertex_fields) * mesh.vertex_count
+            + ['face_index'] * (FACE_SIZE * mesh.face_count))
@@ -1,11 +1,14 @@
 import array
+import copy
 import os
+import tempfile
 import time
 import bpy
 import mathutils
 import struct
 import binascii
 import bmesh
+import numpy as np
 
 from mathutils import Matrix, Vector, Color
 from bpy_extras import io_utils, node_shader_utils
@@ -15,38 +18,26 @@ from bpy_extras.wm_utils.progress_report import (
     ProgressReportSubstep,
 )
 
+from .codec_akimodel import MDL, TypeFormat, write_model, write_model_positions
+
+REQUIRED_PROPERTIES = ('scale', 'vertex_influence', 'internal_tex_size', 'colors', 'width', 'height')
+
+MAX_VERTICES            = 255
+MAX_VERTICES_UNSCALED   = 127   # the top bit of the vertex count is used by meshes without scale
+MAX_FACES               = 255
+
+# modifiers that still deform the frames of a sequence, every other one is ignored like in a single export
+SEQUENCE_MODIFIERS      = {'ARMATURE'}
+
+class ExportError(Exception):
+    pass
+
 def name_compat(name):
     if name is None:
         return 'None'
     else:
         return name.replace(' ', '_')
     
-class MDL:
- def __init__(self):
-    self.scale              = 0
-    self.type               = 0    
-    self.vertex_count       = 0
-    self.face_count         = 0
-    self.vertex_influence   = 0
-    self.offsets            = []
-    self.vertices           = []
-    self.faces              = []
-    self.uvs                = []
-    self.texture_size       = 0
-    
-class TypeFormat:
-    SByte = '<b'
-    Byte = '<B'
-    Int16 = '<h'
-    BInt16 = '>h'
-    UInt16 = '<H'
-    Int32 = '<i'
-    UInt32 = '<I'
-    Int64 = '<l'
-    UInt64 = '<L'
-    Single = '<f'
-    Double = '<d'
-
 def mesh_triangulate(me):
     import bmesh
     bm = bmesh.new()
@@ -55,7 +46,28 @@ def mesh_triangulate(me):
     bm.to_mesh(me)
     bm.free()
 
+def mesh_triangle_loops(me, EXPORT_TRIANGULATE='LOOP_TRIANGLES'):
+    """Loop indices of every triangle of the mesh, three per triangle.
+
+    LOOP_TRIANGLES reads Blender's cached triangulation in bulk and leaves the mesh alone.
+    BMESH triangulates the mesh in place first, which gives the exact face order of older exports.
+    """
+    if EXPORT_TRIANGULATE == 'BMESH':
+        mesh_triangulate(me)
+
+        loop_start = np.empty(len(me.polygons), dtype=np.int32)
+        me.polygons.foreach_get('loop_start', loop_start)
+        return (loop_start[:, None] + np.arange(3, dtype=np.int32)).ravel()
+
+    me.calc_loop_triangles()
+    tri_loops = np.empty(len(me.loop_triangles) * 3, dtype=np.int32)
+    me.loop_triangles.foreach_get('loops', tri_loops)
+    return tri_loops
+
 def mesh_splice_by_island (me):
+    return mesh_clone_by_island(me).original.to_mesh()
+
+def mesh_clone_by_island (me):
     import bmesh
 
     scene = bpy.context.scene
@@ -64,6 +76,11 @@ def mesh_splice_by_island (me):
     ob.data = me.data.copy()
     new_name = ob.name + "_cloned"
     ob.data.name = new_name
+
+    # split on the UV map that gets exported, not whichever one the user made active
+    uv_name, colour_name = variant_layers(ob.data)
+    if uv_name is not None:
+        ob.data.uv_layers.active = ob.data.uv_layers[uv_name]
     
     # link to collection if need be
     scene.collection.objects.link(ob)
@@ -101,23 +118,12 @@ def mesh_splice_by_island (me):
     bpy.ops.object.mode_set(mode='OBJECT')
     bpy.data.objects[ob.name].select_set(True)
 
-    return ob.original.to_mesh()
-
-
-def scale_vertex(n,s):
-    r = round(n * (1.0 * s), 2)
-    return hex(int(r) & 0xFF)[2:].zfill(2)
+    return ob
 
-def scale_uv(n,s):
-    r = round(n * s, 2)
-    return hex(int(r) & 0xFF)[2:].zfill(2)
 
 def veckey2d(v):
     return round(v[0], 4), round(v[1], 4)
     
-def float_to_hex(f):
-    return hex(int(f) & 0xFF)[2:].zfill(2)
-
 def blender_to_rgb(n):
     return hex(int(n * 255) & 0xFF)[2:].zfill(2)
 
@@ -125,177 +131,440 @@ def blender_to_inverted_rgb(n):
     return hex( (int(n * 255) ^ 0xFF))[2:].zfill(2)
 
 
+def gather_mesh(ob_main, me, tri_loops):
+    """Gather the .model data of a spliced mesh, tri_loops are the loops of its triangles from mesh_triangle_loops()."""
+    mesh = MDL()
+
+    mesh.scale              = bpy.data.objects[ob_main.name].data['scale']
+    mesh.vertex_influence   = bpy.data.objects[ob_main.name].data['vertex_influence']
+    mesh.texture_size       = bpy.data.objects[ob_main.name].data['internal_tex_size']
+    mesh.has_colours        = bool(bpy.data.objects[ob_main.name].data['colors'])
+    mesh.width              = bpy.data.objects[ob_main.name].data['width']
+    mesh.height             = bpy.data.objects[ob_main.name].data['height']
+
+    if mesh.scale > 0:
+        mesh.type = 1
+
+    uv_name, colour_name = variant_layers(bpy.data.objects[ob_main.name].data)
+
+    loop_count = len(me.loops)
+
+    # read everything in bulk, indexing the RNA collections per loop is slow
+    co = np.empty(len(me.vertices) * 3, dtype=np.float32)
+    me.vertices.foreach_get('co', co)
+
+    loop_vert = np.empty(loop_count, dtype=np.int32)
+    me.loops.foreach_get('vertex_index', loop_vert)
+
+    me_uvs = {}
+    export_vert_colours = {}
+
+    faceuv = len(me.uv_layers) > 0
+    if faceuv:
+        uv_layer = np.empty(loop_count * 2, dtype=np.float32)
+        (me.uv_layers[uv_name] if uv_name is not None else me.uv_layers.active).data.foreach_get('uv', uv_layer)
+        uv_layer = uv_layer.reshape(-1, 2).tolist()
+
+        if mesh.has_colours:
+            me_colors = np.empty(loop_count * 4, dtype=np.float32)
+            me.vertex_colors[colour_name].data.foreach_get('color', me_colors)
+            me_colors = me_colors.reshape(-1, 4).tolist()
+
+        loop_vert_ls = loop_vert.tolist()
+
+        uv_dict = {}
+        for l_index in tri_loops.tolist():
+            v_index = loop_vert_ls[l_index]
+            uv = uv_layer[l_index]
+
+            uv_key = v_index, veckey2d(uv)
+            if uv_key not in uv_dict:
+                uv_dict[uv_key] = len(uv_dict)
+
+                # store uvs for later use
+                me_uvs[v_index] = uv
+
+                if mesh.has_colours:
+                    # store vert colours
+                    export_vert_colours[v_index] = me_colors[l_index]
+
+        del uv_dict
+
+    mesh.offsets.append(bpy.data.objects[ob_main.name].location[:])
+    mesh.vertices = co.reshape(-1, 3).tolist()
+    mesh.uvs = [me_uvs.get(v_index) for v_index in range(len(mesh.vertices))]
+    if mesh.has_colours:
+        mesh.colours = [export_vert_colours.get(v_index) for v_index in range(len(mesh.vertices))]
+
+    mesh.faces = loop_vert[tri_loops].reshape(-1, 3).tolist()
+    mesh.vertex_count = len(mesh.vertices)
+    mesh.face_count = len(mesh.faces)
+
+    return mesh
+
+
+def variant_layers(data):
+    """UV map and colour layer names of the active variant, None and 'Col' for meshes without variants."""
+    variant = data.get('variants', {}).get(data.get('active_variant', ''))
+    if variant is None:
+        return None, "Col"
+    return variant['uv'], variant['colour'] or "Col"
+
+
+def is_dupli_child(ob):
+    return ob.parent and ob.parent.instance_type in {'VERTS', 'FACES'}
+
+
+def validate_objects(objects):
+    """Check what every object needs before it gets split, returns a list of violations."""
+    errors = []
+
+    for ob in objects:
+        if is_dupli_child(ob):
+            continue
+
+        if ob.type != 'MESH':
+            errors.append("%s: is not a mesh" % ob.name)
+            continue
+
+        missing = [key for key in REQUIRED_PROPERTIES if key not in ob.data]
+        if missing:
+            errors.append("%s: missing custom properties %s" % (ob.name, ", ".join(missing)))
+
+        for key in ('scale', 'vertex_influence', 'internal_tex_size'):
+            if key in ob.data and not 0 <= ob.data[key] <= 255:
+                errors.append("%s: custom property %s is %r, must fit a byte" % (ob.name, key, ob.data[key]))
+
+        uv_name, colour_name = variant_layers(ob.data)
+
+        if len(ob.data.uv_layers) == 0:
+            errors.append("%s: has no UV map" % ob.name)
+        elif uv_name is not None and uv_name not in ob.data.uv_layers:
+            errors.append("%s: has no %r UV map for variant %s" % (ob.name, uv_name, ob.data['active_variant']))
+
+        if ob.data.get('colors') and colour_name not in ob.data.vertex_colors:
+            errors.append("%s: has no %r vertex colour layer" % (ob.name, colour_name))
+
+    return errors
+
+
+# Overflow masks for arrays of positions, UVs and offsets. They mirror the quantize_* functions of
+# the codec: round to 2 decimals, then int() truncates towards zero before the value is masked to a byte.
+
+def position_overflow(co, scale):
+    """Per row of co, True where a coordinate leaves int8 at scale."""
+    co_q = np.trunc(np.round(np.asarray(co, dtype=np.float64) * np.reshape(scale, (-1, 1)), 2))
+    return np.any((co_q < -128) | (co_q > 127), axis=1)
+
+def uv_overflow(uv, width, height):
+    """Per row of uv, True where U or the flipped V leaves a byte at the texture size."""
+    uv = np.asarray(uv, dtype=np.float64)
+    u_q = np.trunc(np.round(uv[:, 0] * width, 2))
+    v_q = np.trunc(np.round((uv[:, 1] * -1 + 1.0) * height, 2))
+    return (u_q < 0) | (u_q > 255) | (v_q < 0) | (v_q > 255)
+
+def offset_overflow(offsets):
+    """Per row of offsets, True where a component leaves int8 after the * 10 scaling."""
+    offsets_q = np.trunc(np.round(np.asarray(offsets, dtype=np.float64), 2) * 10)
+    return np.any((offsets_q < -128) | (offsets_q > 127), axis=1)
+
+
+def validate_meshes(meshes):
+    """Check the gathered arrays of all (name, mesh) pairs at once, returns a list of violations."""
+    errors = []
+
+    for name, mesh in meshes:
+        limit = MAX_VERTICES if mesh.type > 0 else MAX_VERTICES_UNSCALED
+        if mesh.vertex_count > limit:
+            errors.append("%s: %d vertices after the UV island split, at most %d" % (name, mesh.vertex_count, limit))
+        if mesh.face_count > MAX_FACES:
+            errors.append("%s: %d faces after triangulation, at most %d" % (name, mesh.face_count, MAX_FACES))
+
+        missing = sum(1 for uv in mesh.uvs if uv is None)
+        if missing:
+            errors.append("%s: %d vertices are not used by any face and have no UV" % (name, missing))
+        if mesh.has_colours:
+            missing = sum(1 for colour in mesh.colours if colour is None)
+            if missing:
+                errors.append("%s: %d vertices are not used by any face and have no colour" % (name, missing))
+
+    counts = [len(mesh.vertices) for name, mesh in meshes]
+    if sum(counts) == 0:
+        return errors
+
+    owner   = np.repeat(np.arange(len(meshes)), counts)
+    scale   = np.array([max(mesh.scale, 1) for name, mesh in meshes], dtype=np.float64)
+    width   = np.array([mesh.width for name, mesh in meshes], dtype=np.float64)
+    height  = np.array([mesh.height for name, mesh in meshes], dtype=np.float64)
+
+    co = np.array([co[:3] for name, mesh in meshes for co in mesh.vertices], dtype=np.float64).reshape(-1, 3)
+    uv = np.array([uv[:2] if uv is not None else (0.0, 0.0) for name, mesh in meshes for uv in mesh.uvs],
+                  dtype=np.float64).reshape(-1, 2)
+    offsets = np.array([mesh.offsets[0][:3] for name, mesh in meshes], dtype=np.float64)
+
+    co_bad = np.bincount(owner[position_overflow(co, scale[owner])], minlength=len(meshes))
+    uv_bad = np.bincount(owner[uv_overflow(uv, width[owner], height[owner])], minlength=len(meshes))
+    offsets_bad = offset_overflow(offsets)
+
+    for i, (name, mesh) in enumerate(meshes):
+        if co_bad[i]:
+            errors.append("%s: %d vertices overflow int8 at scale %d" % (name, co_bad[i], max(mesh.scale, 1)))
+        if uv_bad[i]:
+            errors.append("%s: %d UVs overflow a byte at %dx%d" % (name, uv_bad[i], mesh.width, mesh.height))
+        if offsets_bad[i]:
+            errors.append("%s: location overflows the int8 offset range of -12.8 to 12.7" % name)
+
+    return errors
+
+
+def raise_errors(errors):
+    if errors:
+        raise ExportError("%d problem(s), nothing was written:\n%s" % (len(errors), "\n".join(errors)))
+
+
+def write_atomic(filepath, data):
+    """Write through a temporary file next to filepath, a failed export never leaves a truncated file behind."""
+    fd, temp_path = tempfile.mkstemp(suffix=".tmp", prefix=os.path.basename(filepath) + ".",
+                                     dir=os.path.dirname(os.path.abspath(filepath)))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+
+        # mkstemp creates the file owner only, keep the mode a plain open() would give
+        try:
+            mode = os.stat(filepath).st_mode & 0o7777
+        except FileNotFoundError:
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0o666 & ~umask
+        os.chmod(temp_path, mode)
+
+        os.replace(temp_path, filepath)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
 def write_file(filepath, objects, depsgraph, scene,
                EXPORT_SCALE='8',
+               EXPORT_TRIANGULATE='LOOP_TRIANGLES',
                progress=ProgressReport(),
                ):
 
     with ProgressReportSubstep(progress, 2, "MODEL Export path: %r" % filepath, "Model Export Finished") as subprogress1:
-        with open(filepath, "wb") as f:
+        raise_errors(validate_objects(objects))
 
-            totverts = totuvco = totno = 1
+        meshes = []
 
-            subprogress1.enter_substeps(len(objects))
-            for i, ob_main in enumerate(objects):
+        subprogress1.enter_substeps(len(objects))
+        for i, ob_main in enumerate(objects):
+
+            # ignore dupli children
+            if is_dupli_child(ob_main):
+                subprogress1.step("Ignoring %s, dupli child..." % ob_main.name)
+                continue
+
+            obs = [(ob_main, ob_main.matrix_world)]
+
+            subprogress1.enter_substeps(len(obs))
+
+            for ob, ob_mat in obs:
+                with ProgressReportSubstep(subprogress1, 3) as subprogress2:
+                    try:
+                        # splice our mesh by UV island. N64 AKI style.
+                        me  = mesh_splice_by_island(ob)
+                    except RuntimeError:
+                        me = None
+
+                    if me is None:
+                        continue
+
+                    # Not sure if the game uses tristrips or regular triangle dump, going with the latter for now, seems to work!
+                    tri_loops = mesh_triangle_loops(me, EXPORT_TRIANGULATE)
+
+                    subprogress2.step()
+
+                    meshes.append((ob_main.name, gather_mesh(ob_main, me, tri_loops)))
+
+                    subprogress2.step()
+
+                    # get rid of our temporary mesh
+                    bpy.ops.object.delete()
+                    bpy.data.objects[ob.name].select_set(True)
+
+        raise_errors(validate_meshes(meshes))
+
+        write_atomic(filepath, b''.join(write_model(mesh) for name, mesh in meshes))
+
+def validate_sequence(objects, EXPORT_SEQUENCE, EXPORT_FRAME_START, EXPORT_FRAME_END):
+    """Check the frame range or shape keys of a sequence before anything is split, returns a list of violations."""
+    errors = []
+
+    if EXPORT_SEQUENCE == 'SHAPE_KEYS':
+        key_counts = {}
+        for ob in objects:
+            if is_dupli_child(ob) or ob.type != 'MESH':
+                continue
+            if ob.data.shape_keys is None:
+                errors.append("%s: has no shape keys to export" % ob.name)
+            else:
+                key_counts[ob.name] = len(ob.data.shape_keys.key_blocks)
+
+        if len(set(key_counts.values())) > 1:
+            errors.append("shape key counts differ: %s"
+                          % ", ".join("%s has %d" % item for item in sorted(key_counts.items())))
+
+    elif EXPORT_FRAME_START > EXPORT_FRAME_END:
+        errors.append("frame range %d to %d is empty" % (EXPORT_FRAME_START, EXPORT_FRAME_END))
+
+    return errors
+
+
+def shape_key_positions(clone):
+    """Vertex positions of a spliced clone for each of its shape keys."""
+    co = array.array('f', [0.0]) * (len(clone.data.vertices) * 3)
+
+    positions = []
+    for kb in clone.data.shape_keys.key_blocks:
+        kb.data.foreach_get('co', co)
+        positions.append([co[i:i + 3] for i in range(0, len(co), 3)])
+    return positions
 
-                mesh = MDL()
 
-                mesh.scale              = bpy.data.objects[ob_main.name].data['scale']
-                mesh.vertex_influence   = bpy.data.objects[ob_main.name].data['vertex_influence']
-                mesh.texture_size       = bpy.data.objects[ob_main.name].data['internal_tex_size']
-                has_vt_colours          = bpy.data.objects[ob_main.name].data['colors']
+def sequence_clone(clone):
+    """Turn off the modifiers of a spliced clone outside SEQUENCE_MODIFIERS.
 
-                # Write Header
-                f.write(mesh.scale.to_bytes(1, byteorder='little'))
+    The template of a sequence is gathered from the mesh without modifiers, so the frames
+    may only move its vertices with shape keys and armatures, never add, remove or reshape them.
+    """
+    for mod in clone.modifiers:
+        if mod.type not in SEQUENCE_MODIFIERS:
+            mod.show_viewport = False
+    return clone
+
+def evaluated_positions(clone, depsgraph):
+    """Vertex positions of a clone from sequence_clone() at the current frame."""
+    ob_eval = clone.evaluated_get(depsgraph)
+    me_eval = ob_eval.to_mesh()
+
+    co = array.array('f', [0.0]) * (len(me_eval.vertices) * 3)
+    me_eval.vertices.foreach_get('co', co)
+    positions = [co[i:i + 3] for i in range(0, len(co), 3)]
+
+    ob_eval.to_mesh_clear()
+    return positions
+
+
+def write_sequence(filepath, objects, depsgraph, scene,
+                   EXPORT_SCALE='8',
+                   EXPORT_TRIANGULATE='LOOP_TRIANGLES',
+                   EXPORT_SEQUENCE='FRAMES',
+                   EXPORT_FRAME_START=1,
+                   EXPORT_FRAME_END=1,
+                   progress=ProgressReport(),
+                   ):
+    """Write a numbered .model file per frame or shape key.
+
+    The island split, triangulation and UV deduplication run once per object,
+    every file after that only re-quantizes the vertex positions. Frames follow
+    shape keys and armatures, other modifiers are ignored like in write_file().
+    """
+    base_name, ext = os.path.splitext(filepath)
+    frame_current = scene.frame_current
+
+    with ProgressReportSubstep(progress, 2, "MODEL Sequence export path: %r" % filepath, "Model Sequence Export Finished") as subprogress1:
+        raise_errors(validate_objects(objects)
+                     + validate_sequence(objects, EXPORT_SEQUENCE, EXPORT_FRAME_START, EXPORT_FRAME_END))
+
+        clones = []
+        meshes = []
+
+        try:
+            subprogress1.enter_substeps(len(objects))
+            for ob_main in objects:
 
-                # Override scale for this particular mesh type
-                if mesh.scale <= 0:
-                    mesh.scale = 1
-                else:
-                    mesh.type = 1
-                    
                 # ignore dupli children
-                if ob_main.parent and ob_main.parent.instance_type in {'VERTS', 'FACES'}:
+                if is_dupli_child(ob_main):
                     subprogress1.step("Ignoring %s, dupli child..." % ob_main.name)
                     continue
-                    
-                obs = [(ob_main, ob_main.matrix_world)]
-
-                subprogress1.enter_substeps(len(obs))
-
-                for ob, ob_mat in obs:
-                    with ProgressReportSubstep(subprogress1, 6) as subprogress2:
-                        uv_unique_count = no_unique_count = 0
-
-                        try:
-                            # splice our mesh by UV island. N64 AKI style.
-                            me  = mesh_splice_by_island(ob)
-                        except RuntimeError:
-                            me = None
-
-                        if me is None:
-                            continue
-
-                        # Not sure if the game uses tristrips or regular triangle dump, going with the latter for now, seems to work!
-                        mesh_triangulate(me)
-
-                        faceuv = len(me.uv_layers) > 0
-                        if faceuv:
-                            uv_layer = me.uv_layers.active.data[:]
-
-                        # access our selected mesh
-                        me_verts    = me.vertices[:]
-                        me_polys    = me.polygons[:]
-                        me_uvs      = {}
-
-                        if bool(has_vt_colours) :
-                            me_colors   = me.vertex_colors["Col"]
-
-                        loops = me.loops
-
-                        face_index_pairs = [(face, index) for index, face in enumerate(me.polygons)]
-
-                        # Different vertex count encoding
-                        if mesh.type > 0:
-                            f.write(len(me_verts).to_bytes(1, byteorder='big'))
-                        else:
-                            # bit encode
-                            encoded_vertcount = (len(me_verts) - 128)
-                            f.write(binascii.unhexlify(hex(encoded_vertcount & 0xFF)[2:]))
-
-                        # Basic header info
-                        f.write(len(me_polys).to_bytes(1, byteorder='big'))
-                        f.write(mesh.vertex_influence.to_bytes(1, byteorder='big'))
-                        
-                        subprogress2.step()
-                
-                        local_offsets = bpy.data.objects[ob_main.name].location
-
-                        # offsets
-                        f.write(binascii.unhexlify(float_to_hex(round(local_offsets[0],2) * 10)))
-                        f.write(binascii.unhexlify(float_to_hex(round(local_offsets[1],2) * 10)))
-                        f.write(binascii.unhexlify(float_to_hex(round(local_offsets[2],2) * 10)))
-                        #f.write(b'\x00')
-                        f.write(mesh.texture_size.to_bytes(1, byteorder='little'))
-
-                        subprogress2.step()
-
-                        export_vert_colours = {}  
-
-                        if faceuv:  
-                            uv = f_index = uv_index = uv_key = uv_val = uv_ls = None
-
-                            uv_face_mapping = [None] * len(face_index_pairs)
-                            uv_dict = {}
-                            uv_get = uv_dict.get
-                            for fa, f_index in face_index_pairs:
-                                uv_ls = uv_face_mapping[f_index] = []
-                                for uv_index, l_index in enumerate(fa.loop_indices):
-                                    uv = uv_layer[l_index].uv
-
-                                    uv_key = loops[l_index].vertex_index, veckey2d(uv)
-                                    uv_val = uv_get(uv_key)
-                                    if uv_val is None:
-                                        uv_val = uv_dict[uv_key] = uv_unique_count
-
-                                        # store uvs for later use                                        
-                                        me_uvs[loops[l_index].vertex_index] = uv[:]
-
-                                        if bool(has_vt_colours) :
-                                            # store vert colours
-                                            export_vert_colours[loops[l_index].vertex_index] = me_colors.data[l_index].color
-
-                                        uv_unique_count += 1
-                                    uv_ls.append(uv_val)
-                                
-                            del uv_dict, uv, f_index, uv_index, uv_ls, uv_get, uv_key, uv_val
-
-                        subprogress2.step()
-
-                        # Vert
-                        tex_offset = 0
-                        for v in me_verts:
-                            scaler_width    = bpy.data.objects[ob_main.name].data['width']
-                            scaler_height   = bpy.data.objects[ob_main.name].data['height']                          
-                    
-                            f.write( binascii.unhexlify(scale_vertex(v.co[0], mesh.scale)))
-                            f.write( binascii.unhexlify(scale_vertex(v.co[1], mesh.scale)))
-                            f.write( binascii.unhexlify(scale_vertex(v.co[2], mesh.scale)))
-
-                            if bool(has_vt_colours) :
-                                f.write(binascii.unhexlify( scale_uv(me_uvs[tex_offset][0], scaler_width )) )
-                                f.write(binascii.unhexlify( scale_uv((me_uvs[tex_offset][1] * -1) + 1.0, scaler_height )) )
-                                
-                                f.write(int(round(export_vert_colours[tex_offset][0] * 255, 4)).to_bytes(1, byteorder='little'))
-                                f.write(int(round(export_vert_colours[tex_offset][1] * 255, 4)).to_bytes(1, byteorder='little'))
-                                f.write(int(round(export_vert_colours[tex_offset][2] * 255, 4)).to_bytes(1, byteorder='little'))
-
-                            else:
-                                f.write(b'\x00\x00')
-                                f.write(binascii.unhexlify( scale_uv(me_uvs[tex_offset][0], scaler_width )) )
-                                f.write(b'\x00')
-                                # flip 
-                                f.write(binascii.unhexlify( scale_uv( (me_uvs[tex_offset][1] * -1) + 1.0, scaler_height ) ) )
-
-                            tex_offset += 1
-
-                        subprogress2.step()
-
-                        for face, f_index in face_index_pairs:
-                            
-                            f_v = [(vi, me_verts[v_idx], l_idx)
-                                   for vi, (v_idx, l_idx) in enumerate(zip(face.vertices, face.loop_indices))]
-                            
-                            for vi, v, li in f_v:
-                                #print(" %d" % (totverts + v.index))
-                                f.write(((totverts + v.index) - 1).to_bytes(1, byteorder='little'))
-
-                        # get rid of our temporary mesh
-                        bpy.ops.object.delete()
-                        bpy.data.objects[ob.name].select_set(True)
+
+                try:
+                    # splice our mesh by UV island. N64 AKI style.
+                    clone = mesh_clone_by_island(ob_main)
+                except RuntimeError:
+                    continue
+
+                clones.append(sequence_clone(clone))
+
+                me = clone.original.to_mesh()
+                tri_loops = mesh_triangle_loops(me, EXPORT_TRIANGULATE)
+
+                meshes.append((ob_main, clone, gather_mesh(ob_main, me, tri_loops)))
+
+                subprogress1.step()
+            subprogress1.leave_substeps()
+
+            number_start = 0 if EXPORT_SEQUENCE == 'SHAPE_KEYS' else EXPORT_FRAME_START
+
+            # per object positions, frame after frame
+            if EXPORT_SEQUENCE == 'SHAPE_KEYS':
+                frame_positions = list(zip(*[[(vertices, bpy.data.objects[ob_main.name].location[:])
+                                              for vertices in shape_key_positions(clone)]
+                                             for ob_main, clone, mesh in meshes]))
+            else:
+                frame_positions = []
+                for frame in range(EXPORT_FRAME_START, EXPORT_FRAME_END + 1):
+                    # evaluate the scene once per frame, then read every clone from it
+                    scene.frame_set(frame)
+
+                    frame_positions.append([(evaluated_positions(clone, depsgraph), bpy.data.objects[ob_main.name].location[:])
+                                            for ob_main, clone, mesh in meshes])
+
+            frames = []
+            for positions in frame_positions:
+                frame_meshes = []
+                for (ob_main, clone, mesh), (vertices, location) in zip(meshes, positions):
+                    frame_mesh = copy.copy(mesh)
+                    frame_mesh.vertices = vertices
+                    frame_mesh.offsets = [location]
+                    frame_meshes.append(frame_mesh)
+                frames.append(frame_meshes)
+
+            raise_errors(validate_meshes([("%s (%d)" % (ob_main.name, number_start + i), frame_mesh)
+                                            for i, frame_meshes in enumerate(frames)
+                                            for (ob_main, clone, mesh), frame_mesh in zip(meshes, frame_meshes)]))
+
+            # topology, UVs and colours are encoded once
+            templates = [write_model(mesh) for ob_main, clone, mesh in meshes]
+
+            subprogress1.enter_substeps(max(len(frames), 1))
+            for i, frame_meshes in enumerate(frames):
+                write_atomic("%s_%04d%s" % (base_name, number_start + i, ext),
+                             b''.join(write_model_positions(data, frame_mesh)
+                                      for data, frame_mesh in zip(templates, frame_meshes)))
+
+                subprogress1.step()
+            subprogress1.leave_substeps()
+
+        finally:
+            scene.frame_set(frame_current)
+
+            # get rid of our temporary meshes
+            bpy.ops.object.select_all(action='DESELECT')
+            for clone in clones:
+                clone.select_set(True)
+            bpy.ops.object.delete()
+
+            for ob_main in objects:
+                ob_main.select_set(True)
+
 
 def _write(context, filepath,
            EXPORT_SCALE,
+           EXPORT_TRIANGULATE,
+           EXPORT_SEQUENCE,
+           EXPORT_FRAME_START,
+           EXPORT_FRAME_END,
            ):
     
     with ProgressReport(context.window_manager) as progress:
@@ -314,7 +583,12 @@ def _write(context, filepath,
 
         progress.enter_substeps(1)
 
-        write_file(full_path, objects, depsgraph, scene, EXPORT_SCALE, progress)
+        if EXPORT_SEQUENCE == 'NONE':
+            write_file(full_path, objects, depsgraph, scene, EXPORT_SCALE, EXPORT_TRIANGULATE, progress)
+        else:
+            write_sequence(full_path, objects, depsgraph, scene,
+                           EXPORT_SCALE, EXPORT_TRIANGULATE, EXPORT_SEQUENCE, EXPORT_FRAME_START, EXPORT_FRAME_END,
+                           progress)
 
         progress.leave_substeps()
 
@@ -322,11 +596,19 @@ def _write(context, filepath,
 def save(context,
          filepath,
          *,
-         global_scale = '2'
+         global_scale = '2',
+         triangulate_method = 'LOOP_TRIANGLES',
+         export_sequence = 'NONE',
+         frame_start = 1,
+         frame_end = 1,
          ):
 
     _write(context, filepath,
            EXPORT_SCALE=global_scale,
+           EXPORT_TRIANGULATE=triangulate_method,
+           EXPORT_SEQUENCE=export_sequence,
+           EXPORT_FRAME_START=frame_start,
+           EXPORT_FRAME_END=frame_end,
            )
 
     return {'FINISHED'}
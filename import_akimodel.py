@@ -10,32 +10,7 @@ import bmesh
 from pathlib import Path
 from bpy_extras.wm_utils.progress_report import ProgressReport
 
-
-class MDL:
- def __init__(self):
-    self.type           = 0
-    self.scale          = 0
-    self.vertex_count   = 0
-    self.face_count     = 0
-    self.texture_size   = 0
-    self.vertex_influence = 0
-    self.offsets       = []
-    self.vertices      = []
-    self.faces         = []
-    self.uvs           = []
-    
-class TypeFormat:
-    SByte = '<b'
-    Byte = '<B'
-    Int16 = '<h'
-    BInt16 = '>h'
-    UInt16 = '<H'
-    Int32 = '<i'
-    UInt32 = '<I'
-    Int64 = '<l'
-    UInt64 = '<L'
-    Single = '<f'
-    Double = '<d'
+from .codec_akimodel import MDL, TypeFormat, geometry_hash, probe_file, read_model
 
 
 def color_srgb_to_scene_linear(c):
@@ -51,13 +26,102 @@ def hex_to_rgb(rgb_str):
 def veckey2d(v):
     return round(v[0], 4), round(v[1], 4)
 
+# Blender allows this many UV maps and colour layers per mesh
+MAX_MESH_LAYERS = 8
+
+def find_variant_mesh(geometry, mesh):
+    """An imported mesh with the same geometry that still has room for another variant."""
+    # orphans are left behind when the imported object is deleted, attaching to them shows nothing
+    used = {ob.data.name for ob in bpy.data.objects if ob.users > 0 and ob.type == 'MESH'}
+
+    for me in bpy.data.meshes:
+        if me.get('geometry_hash') != geometry or 'variants' not in me:
+            continue
+        if me.users == 0 or me.name not in used:
+            continue
+        # edited since it was imported
+        if len(me.vertices) != len(mesh.vertices) or len(me.polygons) != len(mesh.faces):
+            continue
+        if len(me.uv_layers) >= MAX_MESH_LAYERS:
+            continue
+        if mesh.has_colours and len(me.vertex_colors) >= MAX_MESH_LAYERS:
+            continue
+        return me
+    return None
+
+def unique_variant_name(me, name):
+    """name, or name.001, name.002 ... whichever no variant, UV map or colour layer of the mesh uses yet."""
+    taken = set(me['variants'].keys()) | set(me.uv_layers.keys()) | set(me.vertex_colors.keys())
+
+    unique = name
+    i = 1
+    while unique in taken:
+        unique = "%s.%03d" % (name, i)
+        i += 1
+
+    return unique
+
+def add_variant(me, name, uv_name, colour_name, width, height, has_vertex_colours, texture_size, vertex_influence):
+    me['variants'][name] = {
+        'uv':               uv_name,
+        'colour':           colour_name,
+        'width':            int(width),
+        'height':           int(height),
+        'colors':           bool(has_vertex_colours),
+        'internal_tex_size': texture_size,
+        'vertex_influence': vertex_influence,
+    }
+
+def set_variant(me, name):
+    """Make a variant the active UV map, colour layer and export settings of the mesh."""
+    variant = me['variants'][name]
+
+    uv_layer = me.uv_layers[variant['uv']]
+    me.uv_layers.active = uv_layer
+    uv_layer.active_render = True
+
+    if variant['colour']:
+        colour_layer = me.vertex_colors[variant['colour']]
+        me.vertex_colors.active = colour_layer
+        colour_layer.active_render = True
+
+    for key in ('width', 'height', 'colors', 'internal_tex_size', 'vertex_influence'):
+        me[key] = variant[key]
+
+    me['active_variant'] = name
+
+def load_variant(me, name, mesh):
+    """Attach the UVs and colours of a decoded file to a mesh with the same geometry."""
+    loop_vert = [0] * len(me.loops)
+    me.loops.foreach_get('vertex_index', loop_vert)
+
+    uv_layer = me.uv_layers.new(name=unique_variant_name(me, name), do_init=False)
+    uv_layer.data.foreach_set('uv', [c for v in loop_vert for c in mesh.uvs[v]])
+
+    # Blender may still shorten the name, the variant is keyed by the layer
+    name = uv_layer.name
+
+    colour_name = ''
+    if mesh.has_colours and mesh.colours:
+        colour_layer = me.vertex_colors.new(name=name)
+        colour_layer.data.foreach_set('color', [c for v in loop_vert for c in
+                                                (mesh.colours[v][0] / 255, mesh.colours[v][1] / 255, mesh.colours[v][2] / 255, 1)])
+        colour_name = colour_layer.name
+
+    add_variant(me, name, uv_layer.name, colour_name, mesh.width, mesh.height,
+                mesh.has_colours, mesh.texture_size, mesh.vertex_influence)
+    set_variant(me, name)
+
+
 def load(context,
         filepath,
         *,
         relpath=None,
         width_texture_size = "64",
         height_texture_size = "64",
-        has_vertex_colours = False
+        has_vertex_colours = False,
+        auto_detect_layout = False,
+        import_variants = False
         ):
    
     with ProgressReport(context.window_manager) as progress:
@@ -66,119 +130,33 @@ def load(context,
         progress.enter_substeps(3, "Parsing AKI file...")
 
         with open(filepath, 'rb') as f:
-            mesh = MDL()
-            
-            mesh.scale          = int.from_bytes(f.read(1), "little");
+            data = f.read()
 
-            # meshes without scale are read differently
-            if mesh.scale > 0:
-                mesh.type = 1
-            else:
-                mesh.scale += 1
-            
-            mesh.vertex_count       = (int.from_bytes(f.read(1), "little") & 0x7F);
-            mesh.face_count         = int.from_bytes(f.read(1), "little");
-            mesh.vertex_influence   = int.from_bytes(f.read(1), "little");
-
-            # Offset translate
-            scaleIToF = 0.1
-
-            offset_array = []
-            ofsX = round(((struct.unpack(TypeFormat.SByte, f.read(1))[0]) * scaleIToF), 4)
-            ofsY = round(((struct.unpack(TypeFormat.SByte, f.read(1))[0]) * scaleIToF), 4)
-            ofsZ = round(((struct.unpack(TypeFormat.SByte, f.read(1))[0]) * scaleIToF), 4)
-
-            offset_array.append([ofsX, ofsY, ofsZ])
-
-
-            test = 0x37 - 0x80
-            print("HERE : ", 0x37 - 0x80)
-
-            print("KEK :", test & 0x7F)
-
-            # assumed?
-            mesh.texture_size = int.from_bytes(f.read(1), "little");
-
-             # correct the scale for verts
-            scaleIToF = 1.0 / mesh.scale
-
-            vert_array = []
-            faces_array = []
-            uv_array = []
-            vert_colors = {}
-
-            # extrapolate the verts
-            for v in range(0, mesh.vertex_count) :
-
-                if mesh.type >= 1:
-                    # vertex
-                    vtX = round(((struct.unpack(TypeFormat.SByte, f.read(1))[0])* scaleIToF), 4)
-                    vtY = round(((struct.unpack(TypeFormat.SByte, f.read(1))[0])* scaleIToF), 4)
-                    vtZ = round(((struct.unpack(TypeFormat.SByte, f.read(1))[0])* scaleIToF), 4)
-                    vert_array.append([vtX, vtY, vtZ])
-
-                    if has_vertex_colours :
-                        # move to UVs
-                        aU = (float(struct.unpack(TypeFormat.Byte, f.read(1))[0]) / int(width_texture_size) )
-                        aV = (float(struct.unpack(TypeFormat.Byte, f.read(1))[0]) / int(height_texture_size) )
-                        
-                        #print("vt", aU, aV)
-                        uv_array.append([aU, aV])
-
-                        # vertex colours, add this later on!
-                        colour_r = int(((int.from_bytes(f.read(1), "little")  )))
-                        colour_g = int(((int.from_bytes(f.read(1), "little")  )))
-                        colour_b = int(((int.from_bytes(f.read(1), "little")  )))
-
-                        vert_colors[v] = [ colour_r, colour_g, colour_b ]
-                    else:
-                        f.read(2)
-                        
-                        # move to UVs
-                        aU = (float(struct.unpack(TypeFormat.Byte, f.read(1))[0]) / int(width_texture_size) )
-                        f.read(1) 
-                        aV = (float(struct.unpack(TypeFormat.Byte, f.read(1))[0]) / int(height_texture_size) )
-
-                        uv_array.append([aU, aV])
-                        
-                else:
-                    # vertex
-                    vtX = round(((struct.unpack(TypeFormat.SByte, f.read(1))[0])* scaleIToF), 4)
-                    vtY = round(((struct.unpack(TypeFormat.SByte, f.read(1))[0])* scaleIToF), 4)
-                    vtZ = round(((struct.unpack(TypeFormat.SByte, f.read(1))[0])* scaleIToF), 4)
-                    vert_array.append([vtX, vtY, vtZ])
-
-                    # move to UVs
-                    aU = (float(struct.unpack(TypeFormat.Byte, f.read(1))[0]) / int(width_texture_size) )
-                    aV =  ((float(struct.unpack(TypeFormat.Byte, f.read(1))[0]) / int(height_texture_size) ) * -1 + 1.0)
-
-                    uv_array.append([aU, aV])
-
-                    colour_r = int(((int.from_bytes(f.read(1), "little")  )))
-                    colour_g = int(((int.from_bytes(f.read(1), "little")  )))
-                    colour_b = int(((int.from_bytes(f.read(1), "little")  )))
-                    
-                    vert_colors[v] = [ colour_r, colour_g, colour_b ]
+        if auto_detect_layout:
+            probe = probe_file(filepath, data)
+            width_texture_size  = probe.width
+            height_texture_size = probe.height
+            has_vertex_colours  = probe.has_colours
+
+            progress.step("Detected %dx%d texture, %s vertex colours"
+                          % (probe.width, probe.height, "with" if probe.has_colours else "without"))
 
-                    # force vertex colors on for these types
-                    has_vertex_colours = True
+        mesh = read_model(data, width_texture_size, height_texture_size, has_vertex_colours)
 
-                                 
-            mesh.vertices   = vert_array
-            mesh.uvs        = uv_array
-            mesh.offsets    = offset_array
+        # force vertex colors on for meshes without scale
+        has_vertex_colours = mesh.has_colours
+        vert_colors = mesh.colours
 
-            for faces in range(0, mesh.face_count) :
-                # FACES
-                # We needed to add 1 to this with raw Python, Blender doens't require it
-                fX = int(((int.from_bytes(f.read(1), "little")  )))
-                fY = int(((int.from_bytes(f.read(1), "little")  )))
-                fZ = int(((int.from_bytes(f.read(1), "little")  )))
+        geometry = geometry_hash(data)
 
-                #print(fX,fY,fZ)
-                faces_array.append([fX, fY, fZ])
+        if import_variants:
+            variant_mesh = find_variant_mesh(geometry, mesh)
+            if variant_mesh is not None:
+                load_variant(variant_mesh, Path(filepath).stem, mesh)
 
-            mesh.faces = faces_array
+                progress.leave_substeps("Done.")
+                progress.leave_substeps("Added %r as a variant of %r" % (filepath, variant_mesh.name))
+                return {'FINISHED'}
 
         # make mesh
         vertices = mesh.vertices
@@ -188,7 +166,7 @@ def load(context,
         n64_mesh = bpy.data.meshes.new('n64_mesh')
         n64_mesh.from_pydata(vertices, edges, faces)
         n64_mesh.update()
-        n64_mesh.uv_layers.new(name="n64", do_init=False)
+        n64_mesh.uv_layers.new(name=Path(filepath).stem, do_init=False)
         n64_object = bpy.data.objects.new(Path(filepath).stem, n64_mesh)
 
         # update meta data for export
@@ -203,6 +181,7 @@ def load(context,
         n64_mesh['colors'] = has_vertex_colours
         n64_mesh['internal_tex_size'] = mesh.texture_size
         n64_mesh['vertex_influence'] = mesh.vertex_influence
+        n64_mesh['geometry_hash'] = geometry
 
         for face in n64_object.data.polygons:
             face.use_smooth = True
@@ -235,7 +214,17 @@ def load(context,
                         n64_mesh.vertex_colors.active.data[loop_index].color = vertex_colour
                     
                 bpy.ops.object.mode_set(mode = 'OBJECT')
-        
+
+        # the file itself is the first variant, later ones can be attached to this mesh
+        variant_name = n64_mesh.uv_layers.active.name
+
+        n64_mesh['variants'] = {}
+        add_variant(n64_mesh, variant_name, variant_name,
+                    n64_mesh.vertex_colors.active.name if has_vertex_colours else '',
+                    width_texture_size, height_texture_size, has_vertex_colours,
+                    mesh.texture_size, mesh.vertex_influence)
+        n64_mesh['active_variant'] = variant_name
+
         progress.leave_substeps("Done.")
         progress.leave_substeps("Finished importing: %r" % filepath)
 
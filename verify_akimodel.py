@@ -0,0 +1,199 @@
+"""Round-trip verification of AKI .model files, outside of Blender.
+
+Every file of a corpus is decoded with the importer's reader, held the way
+Blender stores it (float32 coordinates and UVs, 8 bit colours) and encoded
+again with the exporter's writer. The output is compared byte by byte and
+mismatches are reported grouped by field.
+
+    python verify_akimodel.py path/to/corpus --jobs 8
+"""
+import argparse
+import os
+import sys
+import time
+
+from array import array
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+if __package__:
+    from . import codec_akimodel
+else:
+    import codec_akimodel
+
+
+def to_float32(values):
+    return array('f', values).tolist()
+
+def blender_roundtrip(mesh):
+    """Store a decoded MDL like load() does and gather it back like write_file() does."""
+    stored = codec_akimodel.MDL()
+
+    # custom properties set by load()
+    stored.scale            = mesh.scale if mesh.type > 0 else 0
+    stored.vertex_influence = mesh.vertex_influence
+    stored.texture_size     = mesh.texture_size
+    stored.has_colours      = mesh.has_colours
+    stored.width            = mesh.width
+    stored.height           = mesh.height
+
+    stored.offsets  = [to_float32(mesh.offsets[0])]
+    stored.vertices = [to_float32(co) for co in mesh.vertices]
+    stored.uvs      = [to_float32(uv) for uv in mesh.uvs]
+    stored.colours  = [[c / 255 for c in colour] for colour in mesh.colours]
+    stored.faces    = mesh.faces
+
+    return stored
+
+
+def verify_file(filepath, width_texture_size, height_texture_size, has_vertex_colours, auto_detect_layout=False):
+    """Round trip a single file, returns (filepath, size, {field: mismatched bytes}, error)."""
+    try:
+        with open(filepath, 'rb') as f:
+            data = f.read()
+
+        if auto_detect_layout:
+            probe = codec_akimodel.probe_file(filepath, data)
+            width_texture_size  = probe.width
+            height_texture_size = probe.height
+            has_vertex_colours  = probe.has_colours
+
+        mesh    = codec_akimodel.read_model(data, width_texture_size, height_texture_size, has_vertex_colours)
+        output  = codec_akimodel.write_model(blender_roundtrip(mesh))
+    except Exception as ex:
+        return filepath, 0, {}, "%s: %s" % (type(ex).__name__, ex)
+
+    mismatches = Counter()
+    layout = codec_akimodel.field_layout(mesh)
+    for i in range(min(len(data), len(output))):
+        if data[i] != output[i]:
+            mismatches[layout[i] if i < len(layout) else 'trailing'] += 1
+
+    if len(data) != len(output):
+        mismatches['length'] += abs(len(data) - len(output))
+
+    return filepath, len(data), dict(mismatches), None
+
+
+def _verify_chunk(args):
+    filepaths, width_texture_size, height_texture_size, has_vertex_colours, auto_detect_layout = args
+    return [verify_file(filepath, width_texture_size, height_texture_size, has_vertex_colours, auto_detect_layout)
+            for filepath in filepaths]
+
+
+def collect_files(paths):
+    filepaths = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.lower().endswith('.model'):
+                        filepaths.append(os.path.join(root, name))
+        else:
+            filepaths.append(path)
+    return filepaths
+
+
+def verify_corpus(filepaths, *,
+                  width_texture_size = 64,
+                  height_texture_size = 64,
+                  has_vertex_colours = False,
+                  auto_detect_layout = False,
+                  jobs = None,
+                  chunk_size = 256,
+                  ):
+    """Verify all filepaths in parallel, returns a report dict."""
+    start = time.perf_counter()
+
+    chunks = [(filepaths[i:i + chunk_size], width_texture_size, height_texture_size, has_vertex_colours, auto_detect_layout)
+              for i in range(0, len(filepaths), chunk_size)]
+
+    field_bytes = Counter()
+    field_files = Counter()
+    failed      = []
+    errors      = []
+    total_bytes = 0
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        for results in executor.map(_verify_chunk, chunks):
+            for filepath, size, mismatches, error in results:
+                total_bytes += size
+                if error is not None:
+                    errors.append((filepath, error))
+                elif mismatches:
+                    failed.append((filepath, mismatches))
+                    field_bytes.update(mismatches)
+                    field_files.update(mismatches.keys())
+
+    elapsed = time.perf_counter() - start
+
+    return {
+        'files':        len(filepaths),
+        'bytes':        total_bytes,
+        'seconds':      elapsed,
+        'failed':       failed,
+        'errors':       errors,
+        'field_bytes':  field_bytes,
+        'field_files':  field_files,
+    }
+
+
+def print_report(report, max_listed=20, file=sys.stdout):
+    files   = report['files']
+    seconds = max(report['seconds'], 1e-9)
+
+    print("Verified %d files (%.1f KiB) in %.2fs: %.0f files/s, %.2f MiB/s"
+          % (files, report['bytes'] / 1024, seconds, files / seconds, report['bytes'] / seconds / (1024 * 1024)),
+          file=file)
+    print("%d identical, %d mismatched, %d failed to round trip"
+          % (files - len(report['failed']) - len(report['errors']), len(report['failed']), len(report['errors'])),
+          file=file)
+
+    if report['field_bytes']:
+        print("\nMismatches by field:", file=file)
+        for field, count in report['field_bytes'].most_common():
+            print("  %-18s %8d bytes in %d files" % (field, count, report['field_files'][field]), file=file)
+
+    if report['failed']:
+        print("\nMismatched files:", file=file)
+        for filepath, mismatches in report['failed'][:max_listed]:
+            print("  %s: %s" % (filepath, ", ".join("%s x%d" % item for item in sorted(mismatches.items()))), file=file)
+        if len(report['failed']) > max_listed:
+            print("  ... and %d more" % (len(report['failed']) - max_listed), file=file)
+
+    if report['errors']:
+        print("\nErrors:", file=file)
+        for filepath, error in report['errors'][:max_listed]:
+            print("  %s: %s" % (filepath, error), file=file)
+        if len(report['errors']) > max_listed:
+            print("  ... and %d more" % (len(report['errors']) - max_listed), file=file)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Round trip AKI .model files through the importer and exporter and diff the bytes.")
+    parser.add_argument('paths', nargs='+', help=".model files or directories to search")
+    parser.add_argument('--width', type=int, default=64, help="texture width used for the import")
+    parser.add_argument('--height', type=int, default=64, help="texture height used for the import")
+    parser.add_argument('--vertex-colours', action='store_true', help="import scaled meshes with vertex colours")
+    parser.add_argument('--auto', action='store_true', help="detect texture size and vertex colours per file, like the importer's Auto Detect")
+    parser.add_argument('-j', '--jobs', type=int, default=None, help="worker processes, defaults to the CPU count")
+    parser.add_argument('--chunk-size', type=int, default=256, help="files handed to a worker at once")
+    parser.add_argument('--max-listed', type=int, default=20, help="files listed per section of the report")
+    args = parser.parse_args(argv)
+
+    report = verify_corpus(collect_files(args.paths),
+                           width_texture_size=args.width,
+                           height_texture_size=args.height,
+                           has_vertex_colours=args.vertex_colours,
+                           auto_detect_layout=args.auto,
+                           jobs=args.jobs,
+                           chunk_size=args.chunk_size,
+                           )
+    print_report(report, args.max_listed)
+
+    return 1 if report['failed'] or report['errors'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())